@@ -10,6 +10,18 @@ from rag_engine import RAGEngine
 
 load_dotenv()
 
+_CODE_VERSION = 4  # bump this to force re-init after code changes
+
+
+# ─────────────────────────────────────────────
+#  Engine factory (cached across reruns)
+# ─────────────────────────────────────────────
+@st.cache_resource(show_spinner=False)
+def get_engine(api_key: str, code_version: int = _CODE_VERSION) -> RAGEngine:
+    """One RAGEngine per (API key, code version), shared across reruns and sessions."""
+    return RAGEngine(api_key=api_key)
+
+
 # ─────────────────────────────────────────────
 #  Page config
 # ─────────────────────────────────────────────
@@ -175,7 +187,9 @@ def _init_state():
     defaults = {
         "rag":           None,
         "chat_history":  [],
+        "history_summary": "",
         "doc_stats":     [],
+        "session_uploaded": set(),  # file names this session indexed itself
         "api_key_valid": False,
         "thinking":      False,
     }
@@ -186,6 +200,22 @@ def _init_state():
 _init_state()
 
 
+def _assistant_message(content: str, sources: list) -> dict:
+    """Build a chat_history entry, pre-rendering the source pills once instead of every rerun."""
+    unique_names = list(dict.fromkeys(s["doc_name"] for s in sources))
+    pills_html = "".join(f'<span class="source-pill">📄 {name}</span>' for name in unique_names)
+    return {
+        "role":    "assistant",
+        "content": content,
+        "sources": sources,
+        "_unique_source_names": unique_names,
+        "_pills_html": (
+            f'<div style="margin-top:4px; margin-bottom:10px;">'
+            f'<small style="color:#64748b;">Sources: </small>{pills_html}</div>'
+        ),
+    }
+
+
 # ─────────────────────────────────────────────
 #  Sidebar
 # ─────────────────────────────────────────────
@@ -205,8 +235,7 @@ with st.sidebar:
         label_visibility="collapsed",
     )
     if api_key_input:
-        _CODE_VERSION = 4  # bump this to force re-init after code changes
-        # Recreate RAGEngine if key changed, not initialized, or code version changed
+        # Re-fetch RAGEngine if key changed, not initialized, or code version changed
         needs_init = (
             st.session_state.rag is None
             or not st.session_state.api_key_valid
@@ -215,12 +244,13 @@ with st.sidebar:
         )
         if needs_init:
             try:
-                st.session_state.rag           = RAGEngine(api_key=api_key_input)
+                st.session_state.rag           = get_engine(api_key_input, _CODE_VERSION)
                 st.session_state.api_key_valid = True
                 st.session_state._last_key     = api_key_input
                 st.session_state._code_ver     = _CODE_VERSION
-                st.session_state.doc_stats     = []
+                st.session_state.session_uploaded = set()
                 st.session_state.chat_history  = []
+                st.session_state.history_summary = ""
                 st.success(f"✅ API key accepted! Embed model: `{st.session_state.rag.embed_model}`", icon="🔓")
             except Exception as e:
                 st.error(f"Invalid key: {e}")
@@ -228,6 +258,14 @@ with st.sidebar:
     else:
         st.info("Add your [Gemini API key](https://aistudio.google.com/app/apikey) to get started.", icon="ℹ️")
 
+    # Re-sync the library with the engine on every rerun: it may hold documents from
+    # the persistent store or another session, and another session may have removed
+    # some. Those are listed but not tracked as this session's uploads, so the
+    # uploader sync never deletes them (only "Clear All" does).
+    if st.session_state.api_key_valid and st.session_state.rag is not None:
+        st.session_state.doc_stats = st.session_state.rag.list_documents()
+        st.session_state.session_uploaded &= {d["file_name"] for d in st.session_state.doc_stats}
+
     st.divider()
 
     # ── Document Upload ──
@@ -240,16 +278,21 @@ with st.sidebar:
     )
 
     if uploaded_files and st.session_state.api_key_valid:
-        # Auto-sync: remove docs from ChromaDB that were removed from uploader
+        # Auto-sync: remove docs from ChromaDB that were removed from uploader.
+        # Only this session's own uploads — documents indexed by other sessions stay.
         uploaded_names = {f.name for f in uploaded_files}
-        removed_docs = [d for d in st.session_state.doc_stats if d["file_name"] not in uploaded_names]
+        removed_docs = [
+            d for d in st.session_state.doc_stats
+            if d["file_name"] in st.session_state.session_uploaded and d["file_name"] not in uploaded_names
+        ]
         for doc in removed_docs:
             try:
                 st.session_state.rag.remove_document(doc["file_name"])
             except Exception:
                 pass
+            st.session_state.session_uploaded.discard(doc["file_name"])
         if removed_docs:
-            st.session_state.doc_stats = [d for d in st.session_state.doc_stats if d["file_name"] in uploaded_names]
+            st.session_state.doc_stats = [d for d in st.session_state.doc_stats if d not in removed_docs]
             st.info(f"🗑️ Removed {len(removed_docs)} document(s) from index.", icon="🔄")
 
         # Index new files
@@ -261,6 +304,7 @@ with st.sidebar:
                     try:
                         stats = st.session_state.rag.ingest_document(f.name, f.read())
                         st.session_state.doc_stats.append(stats)
+                        st.session_state.session_uploaded.add(f.name)
                         ocr_info = f" (🔍 {stats['ocr_pages']} OCR pages)" if stats.get('ocr_pages', 0) > 0 else ""
                         st.success(f"✅ {f.name} indexed ({stats['chunks']} chunks){ocr_info}", icon="📄")
                     except Exception as e:
@@ -292,7 +336,9 @@ with st.sidebar:
                 except Exception:
                     pass
             st.session_state.doc_stats    = []
+            st.session_state.session_uploaded = set()
             st.session_state.chat_history = []
+            st.session_state.history_summary = ""
             st.rerun()
     else:
         st.markdown("<small style='color:#64748b'>No documents uploaded yet.</small>", unsafe_allow_html=True)
@@ -364,19 +410,8 @@ for msg in st.session_state.chat_history:
 
         # Render source citations for assistant messages
         if msg["role"] == "assistant" and msg.get("sources"):
-            unique_sources = {}
-            for s in msg["sources"]:
-                key = s["doc_name"]
-                if key not in unique_sources:
-                    unique_sources[key] = s
-
-            pills_html = "".join(
-                f'<span class="source-pill">📄 {s["doc_name"]}</span>'
-                for s in unique_sources.values()
-            )
             st.markdown(
-                f'<div style="margin-top:4px; margin-bottom:10px;">'
-                f'<small style="color:#64748b;">Sources: </small>{pills_html}</div>',
+                msg.get("_pills_html") or _assistant_message(msg["content"], msg["sources"])["_pills_html"],
                 unsafe_allow_html=True,
             )
 
@@ -411,24 +446,21 @@ if user_input:
                 question=user_input,
                 top_k=6,
                 chat_history=st.session_state.chat_history,
+                history_summary=st.session_state.history_summary,
             )
 
             # st.write_stream renders markdown properly inside chat_message
             streamed_text = st.write_stream(result["stream"])
 
-            st.session_state.chat_history.append({
-                "role":    "assistant",
-                "content": streamed_text,
-                "sources": result["sources"],
-            })
+            st.session_state.chat_history.append(_assistant_message(streamed_text, result["sources"]))
         except Exception as e:
             error_msg = f"❌ Error: {e}"
             st.markdown(error_msg)
-            st.session_state.chat_history.append({
-                "role":    "assistant",
-                "content": error_msg,
-                "sources": [],
-            })
+            st.session_state.chat_history.append(_assistant_message(error_msg, []))
+    # Refresh the running summary of older turns for the next prompt (failed turns too)
+    st.session_state.history_summary = st.session_state.rag.summarize_history(
+        st.session_state.chat_history
+    )
     st.rerun()
 
 # ── Footer actions ──
@@ -437,6 +469,7 @@ if st.session_state.chat_history:
     with col_a:
         if st.button("🗑️ Clear Conversation", use_container_width=True):
             st.session_state.chat_history = []
+            st.session_state.history_summary = ""
             st.rerun()
     with col_b:
         # Build markdown export
@@ -445,7 +478,7 @@ if st.session_state.chat_history:
             role = "**You**" if m["role"] == "user" else "**DocMind AI**"
             md_lines.append(f"{role}: {m['content']}\n")
             if m.get("sources"):
-                src_names = list({s["doc_name"] for s in m["sources"]})
+                src_names = m.get("_unique_source_names") or list(dict.fromkeys(s["doc_name"] for s in m["sources"]))
                 md_lines.append(f"*Sources: {', '.join(src_names)}*\n")
             md_lines.append("---\n")
         st.download_button(
@@ -6,77 +6,255 @@ Uses: google-genai SDK (new, replaces deprecated google-generativeai)
 
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import io
+import json
 import os
-import uuid
+import re
+import sqlite3
+import threading
 import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional, List
 
 import chromadb
+import numpy as np
+from aiolimiter import AsyncLimiter
 from google import genai
 from google.genai import types
-from pypdf import PdfReader
+from pypdf import PdfReader, PdfWriter
+
+try:
+    import pypdfium2 as pdfium  # optional: native (PDFium) text extraction + page rendering
+except ImportError:
+    pdfium = None
+
+
+# On-disk cache location (embeddings, etc.); override with DOCMIND_CACHE_DIR
+CACHE_DIR = os.path.expanduser(os.getenv("DOCMIND_CACHE_DIR", "~/.cache/docmind"))
+
+# Precision of vectors in the embedding cache (memory LRU and SQLite blobs):
+# float16 halves its footprint vs float32 at a negligible cosine-ranking cost.
+# Chroma and the NumPy search mirror keep float32, and freshly embedded vectors
+# reach them before any rounding.
+VEC_DTYPE = np.float16
 
 
 # --------------------------------------------------------------------------- #
 #  Helpers
 # --------------------------------------------------------------------------- #
 
+def _chunk_hash(text: str) -> bytes:
+    """Stable 128-bit digest of a chunk's text."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+# A sentence runs up to terminal punctuation followed by whitespace, or up to a
+# blank line; trailing whitespace stays attached so pieces rejoin losslessly.
+_SENTENCE_RE = re.compile(r".+?(?:[.!?]+(?=\s|$)|(?=\n\s*\n)|$)\s*", re.S)
+
+
 def _chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
-    """Split text into overlapping chunks."""
+    """
+    Split text into chunks of up to `chunk_size` chars, greedily packing whole
+    sentences so boundaries fall on sentence ends. Up to `overlap` chars of
+    trailing sentences are repeated at the start of the next chunk; sentences
+    longer than `chunk_size` are hard-split.
+    """
+    step = chunk_size - overlap
+    sentences = []
+    for m in _SENTENCE_RE.finditer(text):
+        sent = m.group()
+        if len(sent) > chunk_size:
+            sentences.extend(sent[i: i + chunk_size] for i in range(0, len(sent), step))
+        else:
+            sentences.append(sent)
+
     chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end].strip())
-        start += chunk_size - overlap
+    current, size = [], 0
+    for sent in sentences:
+        if current and size + len(sent) > chunk_size:
+            chunks.append("".join(current).strip())
+            # Carry trailing sentences (≤ overlap chars) into the next chunk
+            carry, carry_size = [], 0
+            for prev in reversed(current):
+                if carry_size + len(prev) > overlap:
+                    break
+                carry.insert(0, prev)
+                carry_size += len(prev)
+            if carry_size + len(sent) > chunk_size:
+                carry, carry_size = [], 0
+            current, size = carry, carry_size
+        current.append(sent)
+        size += len(sent)
+    if current:
+        chunks.append("".join(current).strip())
     return [c for c in chunks if len(c) > 50]
 
 
+_OCR_MAX_WORKERS = 8  # concurrent Gemini Vision calls; keep within your quota
+_OCR_RENDER_DPI = 200
+_OCR_JPEG_QUALITY = 85  # ~70 is usually still fine for OCR if bandwidth matters
+_OCR_PROMPT = "Extract ALL text from this document page. Return only the extracted text, nothing else."
+_OCR_WHOLE_DOC_MIN_PAGES = 3  # and at least half the pages — then OCR the PDF in one call
+# Gemini rejects inline requests over ~20 MB, and base64 inflates the file by a
+# third; larger PDFs skip the whole-file call and go straight to per-page OCR
+_OCR_INLINE_MAX_BYTES = 15 * 1024 * 1024
+_OCR_WHOLE_DOC_PROMPT = (
+    "Extract ALL text from every page of this document. Before each page's text, output a line "
+    "'===PAGE n===' where n is the 1-based page number. Return only the extracted text, nothing else."
+)
+_OCR_PAGE_MARKER_RE = re.compile(r"^\s*===\s*PAGE\s+(\d+)\s*===\s*$", re.M)
+
+
 def extract_text_from_pdf(file_bytes: bytes, gemini_client=None, chat_model: str = "gemini-2.5-flash"):
     """
     Hybrid PDF text extraction:
-      1. Try pypdf text extraction per page
-      2. For pages with <50 chars (likely scanned/image), use Gemini Vision OCR
+      1. Extract text per page (pypdfium2 if installed and it can parse the file, else pypdf)
+      2. For pages with <50 chars (likely scanned/image), use Gemini Vision OCR:
+         a single whole-PDF call when most pages need it, else (and for any pages
+         that call missed) parallel per-page calls
     Returns (full_text, page_count, ocr_pages_count).
     """
-    import base64
-
-    reader = PdfReader(io.BytesIO(file_bytes))
-    page_texts = []
-    ocr_count = 0
-
-    for i, page in enumerate(reader.pages):
-        text = (page.extract_text() or "").strip()
+    pdf, page_texts = _pdfium_open(file_bytes)
+    reader = None
+    try:
+        if pdf is None:
+            reader = PdfReader(io.BytesIO(file_bytes))
+            page_texts = [(page.extract_text() or "").strip() for page in reader.pages]
+        ocr_count = 0
 
         # If text extraction returned very little, try Gemini Vision OCR
-        if len(text) < 50 and gemini_client is not None:
-            try:
-                # Convert PDF page to image bytes via Gemini's native PDF support
-                page_pdf = _extract_single_page_pdf(file_bytes, i)
-                response = gemini_client.models.generate_content(
-                    model=chat_model,
-                    contents=[
-                        types.Part.from_bytes(data=page_pdf, mime_type="application/pdf"),
-                        "Extract ALL text from this document page. Return only the extracted text, nothing else.",
-                    ],
-                )
-                ocr_text = response.text.strip()
-                if len(ocr_text) > len(text):
-                    text = ocr_text
+        ocr_needed = [i for i, t in enumerate(page_texts) if len(t) < 50]
+        if gemini_client is None:
+            ocr_needed = []
+
+        # Mostly-scanned document that fits inline: one whole-PDF call instead of one per page;
+        # any page it doesn't return falls through to the per-page path
+        if (
+            len(ocr_needed) >= max(_OCR_WHOLE_DOC_MIN_PAGES, 0.5 * len(page_texts))
+            and len(file_bytes) <= _OCR_INLINE_MAX_BYTES
+        ):
+            whole = _ocr_whole_pdf(gemini_client, chat_model, file_bytes)
+            remaining = []
+            for i in ocr_needed:
+                if i + 1 not in whole:
+                    remaining.append(i)
+                elif len(whole[i + 1]) > len(page_texts[i]):
+                    page_texts[i] = whole[i + 1]
                     ocr_count += 1
-            except Exception:
-                pass  # Fall back to whatever pypdf got
+            ocr_needed = remaining
+
+        if ocr_needed:
+            # Build every page payload up front, serially: neither PDFium nor
+            # PdfReader is thread-safe, and the file is parsed only once.
+            payloads = None
+            if pdf is not None:
+                # A rendered JPEG is far smaller than a one-page PDF, and Gemini
+                # doesn't have to rasterize it again
+                try:
+                    payloads = {i: (_render_page_jpeg(pdf, i), "image/jpeg") for i in ocr_needed}
+                except pdfium.PdfiumError:
+                    pass  # fall back to pypdf page extraction below
+            if payloads is None:
+                reader = reader or PdfReader(io.BytesIO(file_bytes))
+                payloads = {i: (_extract_single_page_pdf(reader, i), "application/pdf") for i in ocr_needed}
+
+            def ocr_page(i: int) -> str:
+                return _ocr_page(gemini_client, chat_model, *payloads[i])
+
+            with ThreadPoolExecutor(max_workers=min(_OCR_MAX_WORKERS, len(ocr_needed))) as executor:
+                for i, ocr_text in zip(ocr_needed, executor.map(ocr_page, ocr_needed)):
+                    if len(ocr_text) > len(page_texts[i]):
+                        page_texts[i] = ocr_text
+                        ocr_count += 1
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+    return "\n".join(page_texts), len(page_texts), ocr_count
+
+
+def _pdfium_open(file_bytes: bytes) -> tuple:
+    """
+    Open a PDF with pypdfium2 and read its page texts. Returns (None, None) when
+    pypdfium2 isn't installed or can't parse the file, so callers fall back to pypdf.
+    """
+    if pdfium is None:
+        return None, None
+    pdf = None
+    try:
+        pdf = pdfium.PdfDocument(file_bytes)
+        return pdf, [_pdfium_page_text(page) for page in pdf]
+    except pdfium.PdfiumError:
+        if pdf is not None:
+            pdf.close()
+        return None, None
+
 
-        page_texts.append(text)
+def _pdfium_page_text(page) -> str:
+    """Extract a pypdfium2 page's text, releasing its native handles."""
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range().replace("\r\n", "\n").strip()
+    finally:
+        textpage.close()
+        page.close()
 
-    return "\n".join(page_texts), len(reader.pages), ocr_count
+
+def _render_page_jpeg(pdf, page_index: int, dpi: int = _OCR_RENDER_DPI, quality: int = _OCR_JPEG_QUALITY) -> bytes:
+    """Rasterize one page of a pypdfium2 document to JPEG bytes."""
+    page = pdf[page_index]
+    try:
+        image = page.render(scale=dpi / 72).to_pil().convert("RGB")
+    finally:
+        page.close()
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
 
 
-def _extract_single_page_pdf(full_pdf_bytes: bytes, page_index: int) -> bytes:
-    """Extract a single page from a PDF as a new PDF byte stream."""
-    from pypdf import PdfWriter
-    reader = PdfReader(io.BytesIO(full_pdf_bytes))
+def _ocr_page(gemini_client, chat_model: str, data: bytes, mime_type: str) -> str:
+    """OCR a single page image (or one-page PDF) with Gemini Vision. Returns "" on failure."""
+    try:
+        response = gemini_client.models.generate_content(
+            model=chat_model,
+            contents=[
+                types.Part.from_bytes(data=data, mime_type=mime_type),
+                _OCR_PROMPT,
+            ],
+        )
+        return (response.text or "").strip()
+    except Exception:
+        return ""  # Fall back to whatever the text layer had
+
+
+def _ocr_whole_pdf(gemini_client, chat_model: str, file_bytes: bytes) -> dict:
+    """
+    OCR a whole PDF with one Gemini call, asking for page-delimited output.
+    Returns {page_number (1-based): text}; empty on failure.
+    """
+    try:
+        response = gemini_client.models.generate_content(
+            model=chat_model,
+            contents=[
+                types.Part.from_bytes(data=file_bytes, mime_type="application/pdf"),
+                _OCR_WHOLE_DOC_PROMPT,
+            ],
+        )
+        parts = _OCR_PAGE_MARKER_RE.split(response.text or "")
+    except Exception:
+        return {}
+    # parts = [preamble, "1", text1, "2", text2, ...]
+    return {int(num): text.strip() for num, text in zip(parts[1::2], parts[2::2])}
+
+
+def _extract_single_page_pdf(reader: PdfReader, page_index: int) -> bytes:
+    """Extract a single page from a parsed PDF as a new PDF byte stream."""
     writer = PdfWriter()
     writer.add_page(reader.pages[page_index])
     buf = io.BytesIO()
@@ -84,11 +262,298 @@ def _extract_single_page_pdf(full_pdf_bytes: bytes, page_index: int) -> bytes:
     return buf.getvalue()
 
 
+_WORD_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can did do does for from has have how i in is it its me my "
+    "of on or our tell that the their there these this those to was were what when where "
+    "which who why will with you your".split()
+)
+
+
+@lru_cache(maxsize=64)
+def _keyword_re(question: str) -> Optional[re.Pattern]:
+    """Whole-word pattern for the question's content words (so "net" won't match "internet")."""
+    keywords = {w for w in _WORD_RE.findall(question.lower()) if len(w) > 2 and w not in _STOPWORDS}
+    if not keywords:
+        return None
+    return re.compile(r"\b(?:" + "|".join(map(re.escape, sorted(keywords))) + r")\b", re.IGNORECASE)
+
+
+def _trim_chunk(chunk: str, question: str, max_chars: int = 400) -> str:
+    """
+    Cut a chunk down to ~max_chars centred on the earliest query keyword it
+    contains as a whole word (or its head if none match), to keep the prompt small.
+    """
+    if len(chunk) <= max_chars:
+        return chunk
+    pattern = _keyword_re(question)
+    match = pattern.search(chunk) if pattern is not None else None
+    first = match.start() if match else 0
+    start = max(0, min(first - max_chars // 2, len(chunk) - max_chars))
+    end = start + max_chars
+    return ("…" if start > 0 else "") + chunk[start:end].strip() + ("…" if end < len(chunk) else "")
+
+
+_FOLLOW_UP_RE = re.compile(
+    r"^\s*(?:and|but|also|so|then|what about|how about|why|more|elaborate|expand|continue|go on)\b"
+    r"|\b(?:tell me more|more detail|it|its|this|that|these|those|they|them|their|he|she|his|her"
+    r"|above|previous|earlier|same|else|again)\b",
+    re.IGNORECASE,
+)
+
+
+def _is_follow_up(question: str) -> bool:
+    """
+    Heuristic: does the question lean on earlier turns (pronouns, "what about…",
+    fewer than two content words) rather than standing on its own?
+    """
+    keywords = [w for w in _WORD_RE.findall(question.lower()) if len(w) > 2 and w not in _STOPWORDS]
+    return len(keywords) < 2 or _FOLLOW_UP_RE.search(question) is not None
+
+
 def extract_text_from_txt(file_bytes: bytes):
     """Return (full_text, page_count=1) from a plain-text byte stream."""
     return file_bytes.decode("utf-8", errors="replace"), 1
 
 
+# --------------------------------------------------------------------------- #
+#  Embedding model selection
+# --------------------------------------------------------------------------- #
+
+_EMBED_CHOICE_PATH = os.path.join(CACHE_DIR, "embed_model.json")
+
+
+def _api_key_id(api_key: str) -> str:
+    """Non-reversible id for an API key, so the key itself never hits disk."""
+    return hashlib.blake2b(api_key.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _load_embed_choice(api_key: str) -> Optional[tuple]:
+    """Return the (api_version, model_name) that last worked for this key, if any."""
+    try:
+        with open(_EMBED_CHOICE_PATH, encoding="utf-8") as f:
+            entry = json.load(f).get(_api_key_id(api_key))
+        return (entry["api_version"], entry["model"]) if entry else None
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _save_embed_choice(api_key: str, api_version: str, model_name: str):
+    """Remember the working (api_version, model_name) for this key. Best-effort."""
+    try:
+        try:
+            with open(_EMBED_CHOICE_PATH, encoding="utf-8") as f:
+                choices = json.load(f)
+        except (OSError, ValueError):
+            choices = {}
+        if not isinstance(choices, dict):
+            choices = {}
+        choices[_api_key_id(api_key)] = {"api_version": api_version, "model": model_name}
+        os.makedirs(os.path.dirname(_EMBED_CHOICE_PATH), exist_ok=True)
+        with open(_EMBED_CHOICE_PATH, "w", encoding="utf-8") as f:
+            json.dump(choices, f, indent=2)
+    except OSError:
+        pass
+
+
+# --------------------------------------------------------------------------- #
+#  Embedding cache
+# --------------------------------------------------------------------------- #
+
+class _EmbeddingCache:
+    """
+    LRU cache of document embeddings (VEC_DTYPE arrays) keyed by (embed model, chunk hash).
+    Backed by SQLite (vectors stored as raw VEC_DTYPE blobs) so re-uploads reuse
+    vectors across sessions. Entries expire `ttl` seconds after they were last
+    written or read, both in memory and on disk.
+    Persistence is best-effort — if the DB can't be opened it runs in memory only.
+    """
+
+    _SQL_VARS = 500  # stay under SQLite's bound-parameter limit
+
+    def __init__(self, path: str, maxsize: int = 10_000, ttl: float = 30 * 24 * 3600):
+        self._mem: OrderedDict = OrderedDict()  # (model, hash) → (np.ndarray, last used)
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeds ("
+                " hash BLOB NOT NULL, model TEXT NOT NULL, vec_blob BLOB NOT NULL, created REAL NOT NULL,"
+                " PRIMARY KEY (hash, model))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeds_created ON embeds (created)")
+            self._db.execute("DELETE FROM embeds WHERE created < ?", (time.time() - ttl,))
+            self._db.commit()
+        except (OSError, sqlite3.Error):
+            self._db = None
+
+    def _remember(self, key: tuple, vec: np.ndarray, now: float):
+        self._mem[key] = (vec, now)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self._maxsize:
+            self._mem.popitem(last=False)
+
+    def get_many(self, model: str, hashes: List[bytes]) -> dict:
+        """Return {hash: vector} for every hash that is cached and not expired."""
+        found = {}
+        now = time.time()
+        cutoff = now - self._ttl
+        with self._lock:
+            missing = []
+            for h in dict.fromkeys(hashes):
+                entry = self._mem.get((model, h))
+                if entry is None or entry[1] < cutoff:
+                    self._mem.pop((model, h), None)
+                    missing.append(h)
+                else:
+                    self._remember((model, h), entry[0], now)
+                    found[h] = entry[0]
+            if self._db is None:
+                return found
+            for i in range(0, len(missing), self._SQL_VARS):
+                part = missing[i: i + self._SQL_VARS]
+                rows = self._db.execute(
+                    "SELECT hash, vec_blob FROM embeds"
+                    f" WHERE model = ? AND created >= ? AND hash IN ({','.join('?' * len(part))})",
+                    (model, cutoff, *part),
+                ).fetchall()
+                for h, blob in rows:
+                    vec = np.frombuffer(blob, dtype=VEC_DTYPE)
+                    self._remember((model, h), vec, now)
+                    found[h] = vec
+            # Sliding expiry: every hit (memory or disk) pushes the row's deadline out.
+            hits = list(found)
+            for i in range(0, len(hits), self._SQL_VARS):
+                part = hits[i: i + self._SQL_VARS]
+                self._db.execute(
+                    f"UPDATE embeds SET created = ? WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                    (now, model, *part),
+                )
+            self._db.commit()
+        return found
+
+    def put_many(self, model: str, items: dict):
+        """Store {hash: vector} pairs and drop rows that have expired since the last write."""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            items = {h: np.asarray(vec, dtype=VEC_DTYPE) for h, vec in items.items()}
+            for h, vec in items.items():
+                self._remember((model, h), vec, now)
+            if self._db is None:
+                return
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeds (hash, model, vec_blob, created) VALUES (?, ?, ?, ?)",
+                [(h, model, vec.tobytes(), now) for h, vec in items.items()],
+            )
+            self._db.execute("DELETE FROM embeds WHERE created < ?", (now - self._ttl,))
+            self._db.commit()
+
+
+# --------------------------------------------------------------------------- #
+#  Semantic query cache
+# --------------------------------------------------------------------------- #
+
+class _SemanticCache:
+    """
+    Answers to the last `maxsize` questions, keyed by query embedding.
+    A question whose cosine similarity to a cached one is ≥ `threshold` reuses
+    that answer. The threshold walks between `ceiling` and `floor` to steer
+    the hit rate toward `target_hit_rate`, but stays at `ceiling` until
+    `min_hits` genuine repeats have been seen.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 500,
+        ceiling: float = 0.97,
+        floor: float = 0.92,
+        target_hit_rate: float = 0.2,
+        step: float = 0.005,
+        min_hits: int = 3,
+    ):
+        self._entries: list = []  # (unit query vector, answer, sources)
+        self._mat: Optional[np.ndarray] = None  # stacked vectors, rebuilt lazily
+        self._maxsize = maxsize
+        self._ceiling, self._floor = ceiling, floor
+        self._target = target_hit_rate
+        self._step = step
+        self._min_hits = min_hits
+        self.threshold = ceiling
+        self._lookups = 0
+        self._hits = 0
+
+    @staticmethod
+    def _unit(vec) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def lookup(self, q_embedding) -> Optional[tuple]:
+        """Return (answer, sources) for a near-duplicate question, else None."""
+        hit = None
+        if self._entries:
+            if self._mat is None:
+                self._mat = np.stack([e[0] for e in self._entries])
+            sims = self._mat @ self._unit(q_embedding)
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                hit = self._entries[best][1:]
+
+        # Adapt: loosen while under the target hit rate, tighten while over it.
+        # Without real repeat traffic there is nothing to tune against, so hold the ceiling.
+        self._lookups += 1
+        self._hits += hit is not None
+        if self._hits >= self._min_hits and self._hits / self._lookups < self._target:
+            self.threshold = max(self._floor, self.threshold - self._step)
+        else:
+            self.threshold = min(self._ceiling, self.threshold + self._step)
+        return hit
+
+    def add(self, q_embedding, answer: str, sources: list):
+        self._entries.append((self._unit(q_embedding), answer, sources))
+        if len(self._entries) > self._maxsize:
+            del self._entries[0]
+        self._mat = None
+
+    def clear(self):
+        self._entries = []
+        self._mat = None
+
+
+# --------------------------------------------------------------------------- #
+#  Process-wide request budget
+# --------------------------------------------------------------------------- #
+
+class _RequestBudget:
+    """
+    Sliding-window limit of `max_requests` per `period` seconds, shared by every
+    thread. Each ingest runs its own event loop (asyncio.run), so an AsyncLimiter
+    can't be shared between them; callers instead reserve a slot here and sleep
+    until it opens.
+    """
+
+    def __init__(self, max_requests: int, period: float):
+        self._max = max_requests
+        self._period = period
+        self._granted: deque = deque()  # start times of the last `max_requests` grants
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Claim the next free slot; returns the seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            start = now
+            if len(self._granted) >= self._max:
+                start = max(now, self._granted.popleft() + self._period)
+            self._granted.append(start)
+            return start - now
+
+
 # --------------------------------------------------------------------------- #
 #  RAG Engine
 # --------------------------------------------------------------------------- #
@@ -110,33 +575,67 @@ class RAGEngine:
         "models/embedding-001",
     ]
     CHAT_MODEL = "gemini-2.5-flash"
+    NO_DOCUMENTS_ANSWER = "⚠️ No documents uploaded yet. Please upload at least one PDF or TXT file."
+
+    # Embedding throughput knobs
+    EMBED_BATCH = 50           # chunks per embed_content call
+    EMBED_MAX_INFLIGHT = 8     # concurrent embed_content calls per upload
+    EMBED_RATE_LIMIT = (500, 60)  # (max requests, per seconds), shared by all uploads on this engine
+    EMBED_RETRIES = 3          # attempts per failed batch
+
+    # Prompt budget
+    CONTEXT_CHARS_PER_CHUNK = 400  # retrieved chunks are trimmed to this around query terms
+    HISTORY_VERBATIM_TURNS = 2     # most recent turns sent as-is; older ones are summarized
+    HISTORY_TURN_CHARS = 160       # per-turn cap inside the summary
+    HISTORY_SUMMARY_CHARS = 800    # cap on the whole summary (oldest lines dropped first)
+
+    # Corpora up to this many chunks are searched with an in-process NumPy
+    # matrix mirrored from Chroma; larger ones fall back to Chroma's HNSW index
+    NUMPY_SEARCH_MAX = 20_000
+
+    # ChromaDB HNSW index settings (fixed once a collection is created)
+    HNSW_PARAMS = {
+        "hnsw:space": "cosine",
+        "hnsw:construction_ef": 200,
+        "hnsw:search_ef": 100,
+        "hnsw:M": 16,
+    }
 
     def __init__(self, api_key: str):
-        # Try both v1 and v1beta to find a working embed model
+        # Try both v1 and v1beta to find a working embed model,
+        # starting with the one that worked last time for this key
         self._client = None
         self.embed_model = None
         errors = []
 
-        for api_ver in ["v1", "v1beta"]:
-            client = genai.Client(
-                api_key=api_key,
-                http_options=types.HttpOptions(api_version=api_ver),
-            )
-            for model_name in self._EMBED_CANDIDATES:
-                try:
-                    client.models.embed_content(
-                        model=model_name,
-                        contents=["test"],
-                    )
-                    # If we get here, this model works!
-                    self._client = client
-                    self.embed_model = model_name
-                    break
-                except Exception as e:
-                    errors.append(f"{api_ver}/{model_name}: {e}")
-                    continue
-            if self.embed_model:
+        candidates = [(v, m) for v in ["v1", "v1beta"] for m in self._EMBED_CANDIDATES]
+        remembered = _load_embed_choice(api_key)
+        if remembered in candidates:
+            candidates.remove(remembered)
+            candidates.insert(0, remembered)
+
+        clients = {}
+        for api_ver, model_name in candidates:
+            if api_ver not in clients:
+                clients[api_ver] = genai.Client(
+                    api_key=api_key,
+                    http_options=types.HttpOptions(api_version=api_ver),
+                )
+            client = clients[api_ver]
+            try:
+                client.models.embed_content(
+                    model=model_name,
+                    contents=["test"],
+                )
+                # If we get here, this model works!
+                self._client = client
+                self.embed_model = model_name
+                if (api_ver, model_name) != remembered:
+                    _save_embed_choice(api_key, api_ver, model_name)
                 break
+            except Exception as e:
+                errors.append(f"{api_ver}/{model_name}: {e}")
+                continue
 
         if self._client is None or self.embed_model is None:
             # Show the first error to help diagnose
@@ -145,12 +644,25 @@ class RAGEngine:
                 f"No working embedding model found. First error: {first_err}"
             )
 
-        self._chroma = chromadb.Client()
+        # Persistent store: indexed documents survive restarts. One collection
+        # per (API key, embed model): vectors from different models don't mix, and
+        # each key's engine owns its collection, mirror and registry outright.
+        self._chroma = chromadb.PersistentClient(path=os.path.join(CACHE_DIR, "chroma"))
         self._collection = self._chroma.get_or_create_collection(
-            name="rag_docs",
-            metadata={"hnsw:space": "cosine"},
+            name="rag_docs_" + re.sub(r"[^A-Za-z0-9]+", "_", self.embed_model).strip("_") + "_" + _api_key_id(api_key),
+            metadata=self.HNSW_PARAMS,
         )
+        # The app shares one engine across Streamlit sessions (threads); this guards
+        # the store, mirror, counters, registry and query cache, which change together.
+        self._lock = threading.RLock()
+        # Tracked locally so hot paths (query, sidebar metric) skip a Chroma count()
+        self._chunk_count = self._collection.count()
         self.doc_registry: dict = {}  # file_name → stats dict
+        self._chunk_hashes: dict = {}  # chunk text hash → ids of every stored chunk with that text
+        self._load_store()
+        self._embed_cache = _EmbeddingCache(os.path.join(CACHE_DIR, "embeds.sqlite"))
+        self._qcache = _SemanticCache()
+        self._embed_budget = _RequestBudget(*self.EMBED_RATE_LIMIT)  # provider quota, across sessions
 
     # ------------------------------------------------------------------ #
     #  Ingestion
@@ -172,29 +684,14 @@ class RAGEngine:
         chunks = _chunk_text(text)
         doc_id = str(uuid.uuid4())[:8]
 
-        BATCH = 50
-        for i in range(0, len(chunks), BATCH):
-            batch = chunks[i: i + BATCH]
-
-            response = self._client.models.embed_content(
-                model=self.embed_model,
-                contents=batch,
-                config=types.EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT"),
-            )
-            embeddings = [e.values for e in response.embeddings]
-
-            self._collection.add(
-                ids=[f"{doc_id}_{i + j}" for j in range(len(batch))],
-                embeddings=embeddings,
-                documents=batch,
-                metadatas=[
-                    {"doc_name": file_name, "doc_id": doc_id, "chunk_idx": i + j}
-                    for j in range(len(batch))
-                ],
-            )
-            if i + BATCH < len(chunks):
-                time.sleep(0.2)
-
+        # Built once for the whole document; batches take slices.
+        # Document-level stats ride along so the registry can be rebuilt on restart.
+        ids = [f"{doc_id}_{k}" for k in range(len(chunks))]
+        doc_meta = {
+            "doc_name": file_name, "doc_id": doc_id,
+            "pages": pages, "chars": len(text), "ocr_pages": ocr_pages,
+        }
+        metadatas = [{**doc_meta, "chunk_idx": k} for k in range(len(chunks))]
         stats = {
             "doc_id": doc_id,
             "file_name": file_name,
@@ -202,19 +699,257 @@ class RAGEngine:
             "chunks": len(chunks),
             "chars": len(text),
             "ocr_pages": ocr_pages,
+            "chunk_ids": ids,  # lets remove_document delete without querying Chroma
         }
-        self.doc_registry[file_name] = stats
+
+        stored: List[str] = []
+        try:
+            asyncio.run(self._aingest_and_store(chunks, ids, metadatas, stored))
+        except BaseException:
+            self._delete_chunks(stored)  # don't leave a half-indexed document behind
+            raise
+
+        with self._lock:
+            # Re-uploading a file replaces the previously indexed copy
+            if file_name in self.doc_registry:
+                self.remove_document(file_name)
+            self._qcache.clear()  # corpus changed — cached answers may be stale
+
+            self.doc_registry[file_name] = stats
         return stats
 
+    def _load_store(self):
+        """
+        Rebuild doc_registry from the chunks already in the persistent store and,
+        for small corpora, load them into the NumPy search mirror — one Chroma get().
+        """
+        self._mirror_reset(enabled=self._chunk_count <= self.NUMPY_SEARCH_MAX)
+        if self._chunk_count == 0:
+            return
+        include = ["metadatas", "embeddings", "documents"] if self._vecs is not None else ["metadatas"]
+        data = self._collection.get(include=include)
+
+        by_doc: dict = {}
+        for chunk_id, meta in zip(data["ids"], data["metadatas"]):
+            stats = by_doc.get(meta["doc_id"])
+            if stats is None:
+                stats = by_doc[meta["doc_id"]] = {
+                    "doc_id": meta["doc_id"],
+                    "file_name": meta["doc_name"],
+                    "pages": meta.get("pages", 0),
+                    "chunks": 0,
+                    "chars": meta.get("chars", 0),
+                    "ocr_pages": meta.get("ocr_pages", 0),
+                    "chunk_ids": [],
+                }
+            stats["chunks"] += 1
+            stats["chunk_ids"].append(chunk_id)
+        self.doc_registry = {stats["file_name"]: stats for stats in by_doc.values()}
+
+        if self._vecs is not None:
+            self._mirror_add(data["ids"], data["embeddings"], data["documents"], data["metadatas"])
+            self._index_hashes(data["ids"], data["documents"])
+
+    # ------------------------------------------------------------------ #
+    #  NumPy search mirror
+    # ------------------------------------------------------------------ #
+
+    def _mirror_reset(self, enabled: bool = True):
+        self._vecs: Optional[np.ndarray] = np.empty((0, 0), dtype=np.float32) if enabled else None
+        self._ids: List[str] = []
+        self._docs: List[str] = []
+        self._metas: List[dict] = []
+        self._id_rows: dict = {}  # chunk id → row in _vecs
+
+    def _mirror_add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict]):
+        """Append unit-normalized rows; switches the mirror off once the corpus outgrows it."""
+        if self._vecs is None or not ids:
+            return
+        if len(self._ids) + len(ids) > self.NUMPY_SEARCH_MAX:
+            self._mirror_reset(enabled=False)  # Chroma's HNSW takes over from here
+            return
+        # float32, not VEC_DTYPE: NumPy has no half-precision BLAS, so a float16
+        # matvec runs ~20x slower than float32
+        vecs = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs /= np.where(norms == 0, 1, norms)
+        self._vecs = np.vstack([self._vecs, vecs]) if self._ids else vecs
+        self._id_rows.update((chunk_id, len(self._ids) + i) for i, chunk_id in enumerate(ids))
+        self._ids.extend(ids)
+        self._docs.extend(documents)
+        self._metas.extend(metadatas)
+
+    def _mirror_remove(self, ids):
+        if self._vecs is None or not self._ids:
+            return
+        drop = set(ids)
+        keep = [i for i, chunk_id in enumerate(self._ids) if chunk_id not in drop]
+        self._vecs = self._vecs[keep]
+        self._ids = [self._ids[i] for i in keep]
+        self._docs = [self._docs[i] for i in keep]
+        self._metas = [self._metas[i] for i in keep]
+        self._id_rows = {chunk_id: i for i, chunk_id in enumerate(self._ids)}
+
+    def _mirror_search(self, q_embedding, top_k: int) -> tuple:
+        """Exact cosine top-k over the mirror. Returns (documents, metadatas), best first."""
+        q = np.asarray(q_embedding, dtype=np.float32)
+        scores = self._vecs @ (q / (np.linalg.norm(q) or 1))
+        k = min(top_k, len(self._ids))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(-scores[top])]
+        return [self._docs[i] for i in top], [self._metas[i] for i in top]
+
+    async def _aingest_and_store(self, chunks: List[str], ids: List[str], metadatas: List[dict], stored: List[str]):
+        """
+        Two-stage pipeline: embedding batches feed a bounded queue drained by a
+        single upsert worker, so Chroma adds for finished batches overlap with
+        embed calls still in flight. Ids that reached the store are appended to `stored`.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        errors: List[BaseException] = []
+
+        async def upsert_worker():
+            while True:
+                indices, vecs = await queue.get()
+                batch_ids = [ids[k] for k in indices]
+                try:
+                    if not errors:  # after a failure, just drain
+                        await asyncio.to_thread(
+                            self._store_batch,
+                            batch_ids, vecs, [chunks[k] for k in indices], [metadatas[k] for k in indices],
+                        )
+                        stored.extend(batch_ids)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    queue.task_done()
+
+        worker = asyncio.create_task(upsert_worker())
+        try:
+            await self._aingest_embeddings(chunks, sink=queue)
+        finally:
+            await queue.join()  # let queued upserts land, even on failure, so rollback sees them
+            worker.cancel()
+        if errors:
+            raise errors[0]
+
+    def _store_batch(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[dict]):
+        """Write one batch to Chroma and the in-process mirror."""
+        with self._lock:
+            self._collection.add(
+                ids=ids,
+                embeddings=embeddings.astype(np.float32).tolist(),
+                documents=documents,
+                metadatas=metadatas,
+            )
+            self._chunk_count += len(ids)
+            self._mirror_add(ids, embeddings, documents, metadatas)
+            self._index_hashes(ids, documents)
+
+    def _delete_chunks(self, ids: List[str]):
+        """Delete chunks by id from Chroma and the in-process mirror."""
+        if not ids:
+            return
+        with self._lock:
+            self._collection.delete(ids=ids)
+            self._chunk_count -= len(ids)
+            self._mirror_remove(ids)
+            # A hash stays indexed while any chunk with that text survives
+            drop = set(ids)
+            self._chunk_hashes = {
+                h: chunk_ids - drop for h, chunk_ids in self._chunk_hashes.items() if not chunk_ids <= drop
+            }
+
+    def _index_hashes(self, ids: List[str], documents: List[str]):
+        for chunk_id, doc in zip(ids, documents):
+            self._chunk_hashes.setdefault(_chunk_hash(doc), set()).add(chunk_id)
+
+    def _indexed_vectors(self, hashes) -> dict:
+        """
+        Vectors of already-stored chunks with the given text hashes, read from the
+        NumPy mirror (or one Chroma get() when the mirror is off). Returns {hash: vector}.
+        """
+        with self._lock:
+            hash_ids = {h: next(iter(self._chunk_hashes[h])) for h in hashes if h in self._chunk_hashes}
+            if not hash_ids:
+                return {}
+            if self._vecs is not None:
+                return {h: self._vecs[self._id_rows[chunk_id]] for h, chunk_id in hash_ids.items()}
+            got = self._collection.get(ids=list(hash_ids.values()), include=["embeddings"])
+        by_id = {chunk_id: np.asarray(vec, dtype=np.float32) for chunk_id, vec in zip(got["ids"], got["embeddings"])}
+        return {h: by_id[chunk_id] for h, chunk_id in hash_ids.items() if chunk_id in by_id}
+
+    async def _aingest_embeddings(self, chunks: List[str], sink: Optional[asyncio.Queue] = None) -> np.ndarray:
+        """
+        Embed chunks in batches of EMBED_BATCH, with up to EMBED_MAX_INFLIGHT
+        requests in flight. EMBED_RATE_LIMIT is enforced engine-wide through
+        _embed_budget, so concurrent uploads share it; the per-call limiter only
+        smooths this upload's bursts.
+        Only texts that are new hit the API: vectors come from the embedding cache
+        or from identical chunks already in the index, and repeated texts within
+        `chunks` are embedded once.
+        Failed batches (e.g. 429s) are retried on their own; order is preserved.
+        Each finished batch is put on `sink` as (chunk_indices, vectors), if given.
+        Returns a (len(chunks), dim) float32 matrix.
+        """
+        hashes = [_chunk_hash(c) for c in chunks]
+        positions: dict = {}  # hash → indices of the chunks with that text
+        for k, h in enumerate(hashes):
+            positions.setdefault(h, []).append(k)
+        known = self._embed_cache.get_many(self.embed_model, hashes)
+        known.update(self._indexed_vectors(h for h in positions if h not in known))
+
+        # Work items are lists of unique hashes; reused ones go first and skip the API
+        reused = [h for h in positions if h in known]
+        missing = [h for h in positions if h not in known]
+        B = self.EMBED_BATCH
+        pending = [reused[i: i + B] for i in range(0, len(reused), B)]
+        pending += [missing[i: i + B] for i in range(0, len(missing), B)]
+
+        semaphore = asyncio.Semaphore(self.EMBED_MAX_INFLIGHT)
+        limiter = AsyncLimiter(*self.EMBED_RATE_LIMIT)
+
+        async def embed_batch(batch: List[bytes]):
+            todo = [h for h in batch if h not in known]
+            if todo:
+                async with semaphore:
+                    await asyncio.sleep(self._embed_budget.reserve())
+                    async with limiter:
+                        response = await self._client.aio.models.embed_content(
+                            model=self.embed_model,
+                            contents=[chunks[positions[h][0]] for h in todo],
+                            config=types.EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT"),
+                        )
+                fresh = {h: np.asarray(e.values, dtype=np.float32) for h, e in zip(todo, response.embeddings)}
+                self._embed_cache.put_many(self.embed_model, fresh)  # rounds its own copy to VEC_DTYPE
+                known.update(fresh)
+            if sink is not None:
+                indices = sorted(k for h in batch for k in positions[h])
+                await sink.put((indices, np.stack([known[hashes[k]] for k in indices], dtype=np.float32)))
+
+        for attempt in range(self.EMBED_RETRIES):
+            outcomes = await asyncio.gather(
+                *(embed_batch(batch) for batch in pending),
+                return_exceptions=True,
+            )
+            failed = [(batch, o) for batch, o in zip(pending, outcomes) if isinstance(o, Exception)]
+            if not failed:
+                break
+            if attempt == self.EMBED_RETRIES - 1:
+                raise failed[0][1]
+            pending = [batch for batch, _ in failed]
+            await asyncio.sleep(2 ** attempt)  # back off before retrying failed batches
+
+        return np.stack([known[h] for h in hashes], dtype=np.float32) if hashes else np.empty((0, 0), dtype=np.float32)
+
     def remove_document(self, file_name: str):
         """Remove all chunks for a document from the vector store."""
-        if file_name not in self.doc_registry:
-            return
-        doc_id = self.doc_registry[file_name]["doc_id"]
-        results = self._collection.get(where={"doc_id": doc_id})
-        if results["ids"]:
-            self._collection.delete(ids=results["ids"])
-        del self.doc_registry[file_name]
+        with self._lock:
+            if file_name not in self.doc_registry:
+                return
+            self._delete_chunks(self.doc_registry[file_name]["chunk_ids"])
+            del self.doc_registry[file_name]
+            self._qcache.clear()
 
     # ------------------------------------------------------------------ #
     #  Retrieval & Generation
@@ -225,16 +960,16 @@ class RAGEngine:
         question: str,
         top_k: int = 6,
         chat_history: Optional[List[dict]] = None,
+        history_summary: Optional[str] = None,
     ) -> dict:
         """
         Retrieve relevant chunks, then generate an answer with citations.
-        Returns: {"answer": str, "sources": [...]}
+        `history_summary` is a precomputed summarize_history(chat_history);
+        it is derived here when omitted.
+        Returns: {"stream": iterator of text, "sources": [...], "get_answer": () -> full answer}
         """
-        if self._collection.count() == 0:
-            return {
-                "answer": "⚠️ No documents uploaded yet. Please upload at least one PDF or TXT file.",
-                "sources": [],
-            }
+        if self._chunk_count == 0:
+            return self._canned_response(self.NO_DOCUMENTS_ANSWER, [])
 
         # 1. Embed the query
         q_response = self._client.models.embed_content(
@@ -244,30 +979,50 @@ class RAGEngine:
         )
         q_embedding = q_response.embeddings[0].values
 
-        # 2. Retrieve top-k chunks
-        results = self._collection.query(
-            query_embeddings=[q_embedding],
-            n_results=min(top_k, self._collection.count()),
-            include=["documents", "metadatas", "distances"],
-        )
+        # Conversation history, minus the current question (it has its own section)
+        history = list(chat_history or [])
+        if history and history[-1]["role"] == "user" and history[-1]["content"] == question:
+            history.pop()
+
+        # Near-duplicate of a recent question? Replay its answer. Follow-ups
+        # ("tell me more", "what about 2023?") depend on earlier turns, so only
+        # self-contained questions read or write the cache.
+        use_cache = not history or not _is_follow_up(question)
+        with self._lock:
+            cached = self._qcache.lookup(q_embedding) if use_cache else None
+            if cached is not None:
+                return self._canned_response(*cached)
 
-        chunks    = results["documents"][0]
-        metadatas = results["metadatas"][0]
+            # 2. Retrieve top-k chunks (exact NumPy search for small corpora, else Chroma HNSW)
+            if self._vecs is not None and self._ids:
+                chunks, metadatas = self._mirror_search(q_embedding, top_k)
+            elif self._chunk_count == 0:  # another session emptied the store since the check above
+                return self._canned_response(self.NO_DOCUMENTS_ANSWER, [])
+            else:
+                results = self._collection.query(
+                    query_embeddings=[q_embedding],
+                    n_results=min(top_k, self._chunk_count),
+                    include=["documents", "metadatas", "distances"],
+                )
+                chunks    = results["documents"][0]
+                metadatas = results["metadatas"][0]
 
         # 3. Build context block
         context_parts = []
         for idx, (chunk, meta) in enumerate(zip(chunks, metadatas)):
             context_parts.append(
-                f"[Source {idx+1} | Document: {meta['doc_name']} | Chunk #{meta['chunk_idx']}]\n{chunk}"
+                f"[Source {idx+1} | Document: {meta['doc_name']} | Chunk #{meta['chunk_idx']}]\n"
+                f"{_trim_chunk(chunk, question, self.CONTEXT_CHARS_PER_CHUNK)}"
             )
         context = "\n\n---\n\n".join(context_parts)
 
-        # 4. Build conversation history (last 6 turns)
-        history_str = ""
-        if chat_history:
-            for turn in chat_history[-6:]:
-                role = "User" if turn["role"] == "user" else "Assistant"
-                history_str += f"{role}: {turn['content']}\n"
+        # 4. Build conversation history (summary of older turns + last few verbatim)
+        if history_summary is None:
+            history_summary = self.summarize_history(history)
+        history_str = f"Earlier in this conversation:\n{history_summary}\n\n" if history_summary else ""
+        for turn in history[-self.HISTORY_VERBATIM_TURNS:]:
+            role = "User" if turn["role"] == "user" else "Assistant"
+            history_str += f"{role}: {turn['content']}\n"
 
         # 5. Build prompt
         prompt = f"""You are a knowledgeable AI assistant. Answer the user's question using ONLY the context below.
@@ -303,16 +1058,45 @@ If the answer is not in the context, say "I don't have enough information in the
                     yield chunk.text
             # Store the full answer for chat history
             stream_with_sources.full_answer = "".join(full_answer)
+            if use_cache and stream_with_sources.full_answer:
+                with self._lock:
+                    self._qcache.add(q_embedding, stream_with_sources.full_answer, sources)
 
         gen = stream_with_sources()
-        return {"stream": gen, "sources": sources, "get_answer": lambda: gen.full_answer}
+        return {"stream": gen, "sources": sources, "get_answer": lambda: stream_with_sources.full_answer}
+
+    @staticmethod
+    def _canned_response(answer: str, sources: list) -> dict:
+        """A ready-made answer (cache hit, empty store) in the same shape as a streamed one."""
+        def replay():
+            yield answer
+
+        return {"stream": replay(), "sources": sources, "get_answer": lambda: answer}
+
+    @classmethod
+    def summarize_history(cls, chat_history: Optional[List[dict]]) -> str:
+        """
+        Condense every turn except the last HISTORY_VERBATIM_TURNS into a short
+        running summary (one clipped line per turn) for the prompt.
+        """
+        lines = []
+        for turn in (chat_history or [])[:-cls.HISTORY_VERBATIM_TURNS]:
+            role = "User" if turn["role"] == "user" else "Assistant"
+            text = " ".join(turn["content"].split())
+            if len(text) > cls.HISTORY_TURN_CHARS:
+                text = text[: cls.HISTORY_TURN_CHARS].rsplit(" ", 1)[0] + "…"
+            lines.append(f"- {role}: {text}")
+        while lines and sum(len(line) + 1 for line in lines) > cls.HISTORY_SUMMARY_CHARS:
+            lines.pop(0)
+        return "\n".join(lines)
 
     # ------------------------------------------------------------------ #
     #  Utilities
     # ------------------------------------------------------------------ #
 
     def total_chunks(self) -> int:
-        return self._collection.count()
+        return self._chunk_count
 
     def list_documents(self) -> list:
-        return list(self.doc_registry.values())
+        with self._lock:
+            return list(self.doc_registry.values())